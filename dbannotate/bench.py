@@ -0,0 +1,157 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import redirect_stdout
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from .main import close_cache, create_db, open_cache, parse_args, run
+from .timer import PhaseTimer
+
+# Number of distinct values of the generated columns, the first ones are
+# constant or have few values to trigger the columns checks
+VALUES_COUNTS = [1, 2, 5, 1000]
+
+
+def generate(filename, tables, columns, fks, missing, duplicates, rows, namespaces, seed=0):
+    """
+    Creates a SQLite database of synthetic tables:
+    - tables are spread over namespaces (name prefixes)
+    - each table has an id primary key, fks foreign keys and missing
+      columns named after another table without a constraint
+    - the duplicates ratio of the tables copy the columns of another table
+    - each table has rows rows
+    """
+    rand = random.Random(seed)
+    conn = sqlite3.connect(filename)
+    names = ['ns%i_table%i' % (no % namespaces, no) for no in range(tables)]
+    definitions = []
+
+    for no, name in enumerate(names):
+        if no and rand.random() < duplicates:
+            # Same columns as a previous table
+            definitions.append(definitions[rand.randrange(no)])
+            continue
+
+        # Foreign keys and missing constraints point to distinct tables
+        others = rand.sample(names, min(fks + missing, tables))
+        _columns = ['id integer primary key']
+        for other in others[:fks]:
+            _columns.append('%s_id integer references %s(id)' % (other, other))
+        for other in others[fks:]:
+            _columns.append('%s_id integer' % other)
+        for col in range(len(_columns), columns):
+            _columns.append('col%i text' % col)
+        definitions.append(_columns)
+
+    for name, _columns in zip(names, definitions):
+        conn.execute('create table %s (%s)' % (name, ', '.join(_columns)))
+        if not rows:
+            continue
+
+        values = []
+        for row in range(rows):
+            line = [row]
+            for col in range(1, len(_columns)):
+                line.append('v%i' % (row % VALUES_COUNTS[col % len(VALUES_COUNTS)]))
+            values.append(line)
+        conn.executemany('insert into %s values (%s)' % (name, ', '.join(['?'] * len(_columns))), values)
+    conn.commit()
+    conn.close()
+
+
+def bench(tables, options):
+    workdir = tempfile.mkdtemp(prefix='db_annotate_bench_')
+    cwd = os.getcwd()
+    try:
+        filename = os.path.join(workdir, 'bench.db')
+        start = time.perf_counter()
+        generate(filename, tables, options.columns, options.fks, options.missing,
+                 options.duplicates, options.rows, options.namespaces, options.seed)
+        generation = time.perf_counter() - start
+
+        # The graphs cache starts empty so that the rendering is measured
+        args = parse_args(['sqlite:///' + filename, '--jobs', str(options.jobs),
+                           '--cache-dir', os.path.join(workdir, 'cache')] + options.args)
+        timer = PhaseTimer()
+        os.chdir(workdir)
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            start = time.perf_counter()
+            db = create_db(args.uri[0], args)
+            open_cache(args)
+            errors = run(db, args, timer)
+            close_cache()
+            total = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+        if options.keep:
+            print('Kept %s' % workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir)
+
+    return {
+        'tables': tables,
+        'columns': options.columns,
+        'fks': options.fks,
+        'missing': options.missing,
+        'duplicates': options.duplicates,
+        'rows': options.rows,
+        'generation': generation,
+        'phases': timer.phases,
+        'total': total,
+        'render_errors': len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark db_annotate on synthetic SQLite databases')
+    parser.add_argument('--tables', default='100,1000',
+                        help='comma separated numbers of tables, one benchmark is run for each (default: %(default)s)')
+    parser.add_argument('--columns', type=int, default=10, help='columns per table (default: %(default)s)')
+    parser.add_argument('--fks', type=int, default=1, help='foreign keys per table (default: %(default)s)')
+    parser.add_argument('--missing', type=int, default=1,
+                        help='columns per table named after another table, without constraint (default: %(default)s)')
+    parser.add_argument('--duplicates', type=float, default=0.05,
+                        help='ratio of tables with the same columns as another one (default: %(default)s)')
+    parser.add_argument('--rows', type=int, default=20, help='rows per table (default: %(default)s)')
+    parser.add_argument('--namespaces', type=int, default=10, help='number of tables prefixes (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='db_annotate --jobs (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file instead of the standard output')
+    parser.add_argument('--keep', action='store_true', help='keep the generated databases and output files')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help='other db_annotate options, after --')
+    options = parser.parse_args()
+    if options.args[:1] == ['--']:
+        options.args = options.args[1:]
+
+    results = []
+    for tables in options.tables.split(','):
+        print('Benchmarking %s tables' % tables, file=sys.stderr)
+        results.append(bench(int(tables), options))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
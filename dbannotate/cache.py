@@ -0,0 +1,152 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import threading
+
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'db_annotate')
+# In MiB
+CACHE_SIZE = 1024
+
+
+class FileCache:
+    """
+    Files stored by content hash, in a directory which may be shared by
+    concurrent runs.
+
+    Each entry is a directory holding named files, the least recently used
+    entries are removed by prune() when the cache exceeds max_size bytes.
+    """
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_SIZE * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # The counters are updated by the rendering threads
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, filenames):
+        """
+        Copies the files of the entry key to filenames, a dict of name in
+        the entry to destination path. Returns False when the entry is missing.
+        """
+        path = self._path(key)
+        try:
+            for name, filename in filenames.items():
+                shutil.copyfile(os.path.join(path, name), filename)
+            # The modification time of the entry is its last use
+            os.utime(path)
+        except (IOError, OSError):
+            self._count(False)
+            return False
+        self._count(True)
+        return True
+
+    def get_content(self, key, name):
+        """
+        Returns the content of the file name of the entry key, or None when
+        the entry is missing
+        """
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, name), 'rb') as f:
+                content = f.read()
+            os.utime(path)
+        except (IOError, OSError):
+            self._count(False)
+            return None
+        self._count(True)
+        return content
+
+    def put(self, key, filenames):
+        """
+        Stores the files in the entry key, filenames is a dict of name in the
+        entry to source path
+        """
+        def fill(tmp):
+            for name, filename in filenames.items():
+                shutil.copyfile(filename, os.path.join(tmp, name))
+        self._store(key, fill)
+
+    def put_content(self, key, contents):
+        """
+        Stores the entry key, contents is a dict of name in the entry to
+        bytes
+        """
+        def fill(tmp):
+            for name, content in contents.items():
+                with open(os.path.join(tmp, name), 'wb') as f:
+                    f.write(content)
+        self._store(key, fill)
+
+    def _store(self, key, fill):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Entries are filled aside and moved at once so that readers never see
+        # a partial entry
+        tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.tmp')
+        try:
+            fill(tmp)
+            os.rename(tmp, path)
+        except OSError:
+            # Another run stored the same entry meanwhile
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def prune(self):
+        """
+        Removes the least recently used entries until the cache fits in
+        max_size
+        """
+        entries = []
+        total = 0
+        for prefix in os.listdir(self.directory):
+            prefix = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix):
+                continue
+            for key in os.listdir(prefix):
+                if key.startswith('.'):
+                    # Entry being stored
+                    continue
+                path = os.path.join(prefix, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+                    entries.append((os.path.getmtime(path), size, path))
+                except OSError:
+                    continue
+                total += size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
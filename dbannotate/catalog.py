@@ -0,0 +1,426 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import json
+import threading
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.schema import MetaData, Table
+
+# Row count strategies:
+# - exact: select count(*) on every table
+# - estimate: read the planner statistics, count only when the database has none
+# - hybrid: count tables smaller than EXACT_COUNT_MAX_SIZE bytes, estimate the others
+ROW_COUNT_STRATEGIES = ('estimate', 'exact', 'hybrid')
+ROW_COUNT = 'hybrid'
+EXACT_COUNT_MAX_SIZE = 64 * 1024 * 1024
+
+# Analyze all the schemas, except the SYSTEM_SCHEMAS
+ALL_SCHEMAS = '*'
+SYSTEM_SCHEMAS = ('information_schema', 'mysql', 'performance_schema', 'sys')
+
+
+# TODO: merge this function with db_size.humanize
+def sizeof_fmt(num, suffix='B'):
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
+
+
+class TableName(str):
+    """
+    Name of a table, qualified by its schema unless it is in the default
+    schema. name is the name of the table in its schema, schema is None for
+    the default schema.
+    """
+    def __new__(cls, name, schema=None):
+        self = str.__new__(cls, name if schema is None else '%s.%s' % (schema, name))
+        self.name = name
+        self.schema = schema
+        return self
+
+
+def _read_histogram(histogram):
+    """
+    Returns the distinct values count and the most common values of a MySQL
+    column histogram
+    """
+    if isinstance(histogram, (str, bytes)):
+        histogram = json.loads(histogram)
+    buckets = histogram.get('buckets', [])
+
+    if histogram.get('histogram-type') != 'singleton':
+        # Equi-height buckets: [lower, upper, cumulative frequency, distinct values count]
+        return sum(bucket[3] for bucket in buckets), []
+
+    # Singleton buckets: [value, cumulative frequency]
+    values = []
+    previous = 0
+    for value, frequency in buckets:
+        if isinstance(value, str) and value.startswith('base64:'):
+            # Strings are encoded as base64:type<column type>:<data>
+            value = base64.b64decode(value.split(':', 2)[2]).decode('utf-8', 'replace')
+        values.append((value, frequency - previous))
+        previous = frequency
+    values.sort(key=lambda value: value[1], reverse=True)
+    return len(buckets), values
+
+
+class Catalog:
+    """
+    Snapshot of the database catalog.
+
+    Every piece of metadata is loaded from the database the first time it is
+    requested and then served from memory, until invalidate() is called.
+    The catalog can be shared by several threads. Without read_data, the
+    tables are never read, rows counts come from the planner statistics only
+    and are 0 when the database has none.
+
+    The tables of the schemas list (ALL_SCHEMAS for all of them) are
+    analyzed, only the default schema when it is None. Tables are
+    identified by their TableName.
+    """
+    def __init__(self, engine, row_count=ROW_COUNT, read_data=True, schemas=None):
+        if row_count not in ROW_COUNT_STRATEGIES:
+            raise Exception('Invalid row count strategy %s' % row_count)
+        self.engine = engine
+        self.row_count = row_count
+        self.read_data = read_data
+        self.schemas = schemas
+        # Serializes the loading of the whole database metadata, per table
+        # metadata may be loaded twice by concurrent threads, which is harmless
+        self._lock = threading.RLock()
+        self.invalidate()
+
+    def invalidate(self):
+        # A new inspector drops the reflection cache of SQLAlchemy as well
+        self.inspector = Inspector.from_engine(self.engine)
+        self._schemas = None
+        self._tables = None
+        self._inherited = None
+        self._relation_sizes = None
+        self._column_statistics = None
+        self._reflected = {}
+        self._columns = {}
+        self._pk = {}
+        self._foreign_keys = {}
+        self._indexes = {}
+        self._sizes = {}
+        self._triggers = None
+        self._derived = {}
+
+    def _per_table(self, cache, table, loader):
+        if table not in cache:
+            table = self.get_table_name(table)
+            cache[table] = loader(table)
+        return cache[table]
+
+    def memo(self, key, loader):
+        """
+        Cache a value derived from the catalog, it is dropped on invalidate()
+        """
+        with self._lock:
+            if key not in self._derived:
+                self._derived[key] = loader()
+            return self._derived[key]
+
+    def get_schemas(self):
+        """
+        The analyzed schemas, None stands for the default schema
+        """
+        with self._lock:
+            if self._schemas is None:
+                self._schemas = self._load_schemas()
+            return self._schemas
+
+    def get_tables(self):
+        with self._lock:
+            if self._tables is None:
+                self._tables = [TableName(table, schema) for schema in self.get_schemas()
+                                for table in self.inspector.get_table_names(schema=schema)]
+            return self._tables
+
+    def get_table(self, table, schema=None):
+        """
+        Returns the TableName of the table of the schema, as named by the
+        database
+        """
+        if schema == self.inspector.default_schema_name:
+            schema = None
+        return TableName(table, schema)
+
+    def get_table_name(self, table):
+        """
+        Returns the TableName of a table name returned by get_tables()
+        """
+        if isinstance(table, TableName):
+            return table
+        tables = self.memo('tables_by_name', lambda: dict((str(t), t) for t in self.get_tables()))
+        return tables.get(table) or TableName(table)
+
+    def reflect_table(self, table):
+        """
+        Returns the SQLAlchemy Table of the table, the tables referenced by
+        its foreign keys are not reflected
+        """
+        def reflect(table):
+            _table = Table(table.name, MetaData(), schema=table.schema)
+            self.inspector.reflecttable(_table, None, resolve_fks=False)
+            return _table
+        return self._per_table(self._reflected, table, reflect)
+
+    def get_columns(self, table):
+        return self._per_table(self._columns, table,
+                               lambda table: self.inspector.get_columns(table.name, schema=table.schema))
+
+    def get_pk_constraint(self, table):
+        return self._per_table(self._pk, table,
+                               lambda table: self.inspector.get_pk_constraint(table.name, schema=table.schema))
+
+    def get_foreign_keys(self, table):
+        return self._per_table(self._foreign_keys, table,
+                               lambda table: self.inspector.get_foreign_keys(table.name, schema=table.schema))
+
+    def get_indexes(self, table):
+        return self._per_table(self._indexes, table,
+                               lambda table: self.inspector.get_indexes(table.name, schema=table.schema))
+
+    def prefetch(self, tables):
+        """
+        Loads the columns, keys and indexes of the tables
+        """
+        for table in tables:
+            # Reflected first: the SQLite dialect sorts the cached columns
+            # in place when it loads the primary key
+            self.reflect_table(table)
+            self.get_columns(table)
+            self.get_pk_constraint(table)
+            self.get_foreign_keys(table)
+            self.get_indexes(table)
+
+    def get_inherited_tables(self):
+        with self._lock:
+            if self._inherited is None:
+                self._inherited = self._load_inherited_tables()
+            return self._inherited
+
+    def get_relation_sizes(self):
+        """
+        Sizes of all tables of the database, keyed by (schema, table)
+        """
+        with self._lock:
+            if self._relation_sizes is None:
+                self._relation_sizes = self._load_relation_sizes()
+            return self._relation_sizes
+
+    def get_column_statistics(self):
+        """
+        Planner statistics of the columns, keyed by (table, column): (distinct values count, [(value, frequency), ...]).
+        The distinct values count is negative when it is a ratio of the rows
+        count, values are the most common ones, by decreasing frequency.
+        """
+        with self._lock:
+            if self._column_statistics is None:
+                self._column_statistics = self._load_column_statistics()
+            return self._column_statistics
+
+    def get_table_size(self, table):
+        return self._per_table(self._sizes, table, self._load_table_size)
+
+    def is_row_count_known(self, table):
+        """
+        False when the tables data is not read and the planner has no
+        estimate of the rows count of the table
+        """
+        if self.read_data:
+            return True
+        return self._get_relation_size(self.get_table_name(table))[2] is not None
+
+    def get_all_triggers(self):
+        """
+        Triggers of all the tables, keyed by table
+        """
+        with self._lock:
+            if self._triggers is None:
+                self._triggers = self._load_triggers()
+            return self._triggers
+
+    def get_triggers(self, table):
+        return self.get_all_triggers().get(table, [])
+
+    def _get_schema_names(self):
+        # Names of the analyzed schemas, for the catalog queries
+        return [schema or self.inspector.default_schema_name for schema in self.get_schemas()]
+
+    def _load_schemas(self):
+        if self.schemas is None:
+            return [None]
+        schemas = self.schemas
+        if schemas == ALL_SCHEMAS:
+            schemas = [schema for schema in self.inspector.get_schema_names()
+                       if schema not in SYSTEM_SCHEMAS and not schema.startswith('pg_')]
+        default = self.inspector.default_schema_name
+        return [None if schema == default else schema for schema in schemas]
+
+    def _load_inherited_tables(self):
+        # Based on http://stackoverflow.com/questions/1461722/how-to-find-child-tables-that-inherit-from-another-table-in-psql
+        try:
+            r = self.engine.execute('''SELECT
+                pn.nspname, p.relname AS parent, cn.nspname, c.relname AS child
+            FROM
+                pg_inherits JOIN pg_class AS c ON (inhrelid=c.oid)
+                    JOIN pg_namespace AS cn ON (c.relnamespace=cn.oid)
+                    JOIN pg_class as p ON (inhparent=p.oid)
+                    JOIN pg_namespace AS pn ON (p.relnamespace=pn.oid);''')
+            res = r.fetchall()
+        except Exception:
+            # if not supported by db
+            return []
+
+        # Only the tables of the analyzed schemas are kept
+        tables = set(self.get_tables())
+        inherited = []
+        for parent_schema, parent, child_schema, child in res:
+            parent, child = self.get_table(parent, parent_schema), self.get_table(child, child_schema)
+            if parent in tables and child in tables:
+                inherited.append((parent, child))
+        return inherited
+
+    def _load_relation_sizes(self):
+        # Based on http://www.niwi.be/2013/02/17/postgresql-database-table-indexes-size/
+        dialect = self.engine.dialect.name
+        if dialect == 'postgresql':
+            query = '''SELECT n.nspname, c.relname,
+                    pg_relation_size(c.oid), pg_total_relation_size(c.oid), c.reltuples
+                FROM pg_class c
+                    JOIN pg_namespace n ON (c.relnamespace = n.oid)
+                WHERE c.relkind IN ('r', 'p')
+                    AND n.nspname IN :schemas'''
+        elif dialect == 'mysql':
+            query = '''SELECT table_schema, table_name,
+                    data_length, data_length + index_length, table_rows
+                FROM information_schema.TABLES
+                WHERE table_type = 'BASE TABLE'
+                    AND table_schema IN :schemas'''
+        else:
+            # no size catalog available
+            return {}
+
+        sizes = {}
+        try:
+            # Only the analyzed schemas, the server may host many databases
+            r = self.engine.execute(text(query).bindparams(bindparam('schemas', expanding=True)),
+                                    schemas=self._get_schema_names())
+            for schema, table, size, total_size, rows in r:
+                if rows is not None:
+                    # reltuples is -1 on tables that were never analyzed,
+                    # their rows count is unknown
+                    rows = int(rows) if rows >= 0 else None
+                sizes[(schema, table)] = (int(size or 0), int(total_size or 0), rows)
+        except ProgrammingError:
+            # On permission denied
+            pass
+        return sizes
+
+    def _load_column_statistics(self):
+        dialect = self.engine.dialect.name
+        statistics = {}
+        try:
+            if dialect == 'postgresql':
+                # most_common_vals is an anyarray, its values are read as text
+                r = self.engine.execute(text('''SELECT schemaname, tablename, attname, n_distinct,
+                        most_common_vals::text::text[], most_common_freqs
+                    FROM pg_stats
+                    WHERE schemaname IN :schemas
+                    ORDER BY inherited''').bindparams(bindparam('schemas', expanding=True)),
+                    schemas=self._get_schema_names())
+                # Inheritance parents have statistics with (inherited) and
+                # without their children: the former come last and are kept,
+                # as a select on a parent table reads its children as well
+                for schema, table, column, distinct, values, freqs in r:
+                    statistics[(self.get_table(table, schema), column)] = (distinct, list(zip(values or [], freqs or [])))
+            elif dialect == 'mysql':
+                # Only the columns with an histogram (ANALYZE TABLE ... UPDATE HISTOGRAM) have statistics
+                r = self.engine.execute(text('''SELECT schema_name, table_name, column_name, histogram
+                    FROM information_schema.COLUMN_STATISTICS
+                    WHERE schema_name IN :schemas''').bindparams(bindparam('schemas', expanding=True)),
+                    schemas=self._get_schema_names())
+                for schema, table, column, histogram in r:
+                    statistics[(self.get_table(table, schema), column)] = _read_histogram(histogram)
+        except Exception:
+            from traceback import print_exc
+            print_exc()
+            # if not supported by db
+        return statistics
+
+    def _get_relation_size(self, table):
+        key = (table.schema or self.inspector.default_schema_name, table.name)
+        return self.get_relation_sizes().get(key, (0, 0, None))
+
+    def _load_table_size(self, table):
+        size, total_size, estimate = self._get_relation_size(table)
+        try:
+            count = self._count_rows(table, size, estimate)
+        except ProgrammingError:
+            # On permission denied
+            return ['0', '0', 0, 0, 0]
+        return [sizeof_fmt(size), sizeof_fmt(total_size), size, total_size, int(count)]
+
+    def _count_rows(self, table, size, estimate):
+        # estimate is None when the database has no planner statistics
+        if not self.read_data:
+            return estimate or 0
+        if self.row_count != 'exact' and estimate is not None:
+            if self.row_count == 'estimate' or size > EXACT_COUNT_MAX_SIZE:
+                return estimate
+
+        preparer = self.engine.dialect.identifier_preparer
+        name = preparer.quote(table.name)
+        if table.schema is not None:
+            name = preparer.quote_schema(table.schema) + '.' + name
+        r = self.engine.execute('select count(*) from %s' % name)
+        return r.fetchone()[0]
+
+    def _load_triggers(self):
+        # http://serverfault.com/questions/331024/how-can-i-show-the-content-of-a-trigger-with-psql
+        if self.engine.dialect.name not in ('postgresql', 'mysql'):
+            # no information_schema
+            return {}
+        triggers = {}
+        try:
+            r = self.engine.execute(text('''SELECT event_object_schema,
+                        event_object_table,
+                        trigger_name,
+                        event_manipulation,
+                        action_statement,
+                        action_timing
+                    FROM information_schema.triggers
+                    WHERE event_object_schema IN :schemas
+                    ORDER BY event_object_schema,event_object_table,event_manipulation''').bindparams(
+                        bindparam('schemas', expanding=True)),
+                schemas=self._get_schema_names())
+            for row in r:
+                triggers.setdefault(self.get_table(row[1], row[0]), []).append(tuple(row[2:]))
+        except Exception:
+            from traceback import print_exc
+            print_exc()
+            # if not supported by db
+        return triggers
@@ -15,44 +15,130 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import Counter
 import sys
 
 from sqlalchemy import create_engine
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.exc import ProgrammingError, InvalidRequestError
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import InvalidRequestError, ProgrammingError
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.schema import MetaData, Table
-from sqlalchemy.sql import func
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.types import Boolean, Enum, Integer
 
+from .catalog import Catalog, ROW_COUNT
+from .sample import Sampler, SAMPLE_METHOD, SAMPLE_SIZE
+
 MIN_TABLE_SIZE = 10
-ROW_LIMIT = 1000
+# Maximum number of connections to the database
+POOL_SIZE = 32
+# Number of stored functions fetched at once
+FUNCTIONS_FETCH_SIZE = 100
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        # json documents, arrays... are counted by their representation
+        return repr(value)
+    return value
+
+
+class ColumnInfo:
+    """
+    Column of a table as displayed: its type and default value are strings,
+    errors are the findings on its values
+    """
+    def __init__(self, name, type, nullable, unique, default=None, errors=None):
+        self.name = name
+        self.type = type
+        self.nullable = nullable
+        self.unique = unique
+        self.default = default
+        self.errors = errors or []
+
+    @classmethod
+    def from_column(cls, col):
+        default = None
+        if col.server_default is not None:
+            default = str(col.server_default.arg)
+        return cls(col.name, str(col.type).lower(), col.nullable, col.unique, default)
+
+    def dump(self):
+        """
+        Returns the column as a json serializable list, see load()
+        """
+        return [self.name, self.type, self.nullable, self.unique, self.default, self.errors]
+
+    @classmethod
+    def load(cls, data):
+        return cls(*data)
 
-# TODO: merge this function with db_size.humanize
-def sizeof_fmt(num, suffix='B'):
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
 
 class DB:
-    def __init__(self, url):
-        self.engine = create_engine(url, echo=False, pool_recycle=3600, pool_timeout=3600, pool_size=32)
-        self.inspector = Inspector.from_engine(self.engine)
+    def __init__(self, url, row_count=ROW_COUNT, sample_method=SAMPLE_METHOD, sample_size=SAMPLE_SIZE,
+                 stats_only=False, schemas=None):
+        url = make_url(url)
+        if url.drivername.startswith('sqlite'):
+            # SQLite connections are not pooled by default, and each new
+            # connection parses the whole schema again
+            self.engine = create_engine(url, echo=False, poolclass=QueuePool, pool_size=POOL_SIZE,
+                                        connect_args={'check_same_thread': False})
+        else:
+            self.engine = create_engine(url, echo=False, pool_recycle=3600, pool_timeout=3600, pool_size=POOL_SIZE)
+        # With stats_only, the tables data is never read, columns values are
+        # checked from the planner statistics and row_count is ignored
+        self.stats_only = stats_only
+        if stats_only:
+            row_count = 'estimate'
+        self.catalog = Catalog(self.engine, row_count, read_data=not stats_only, schemas=schemas)
+        self.sampler = Sampler(self.engine, sample_method, sample_size)
         self.Session = sessionmaker()
         self.Session.configure(bind=self.engine)
 
+    @property
+    def inspector(self):
+        return self.catalog.inspector
+
+    @property
+    def url(self):
+        # The password is hidden
+        return repr(self.engine.url)
+
+    def invalidate(self):
+        self.catalog.invalidate()
+
     def get_tables(self):
-        return self.inspector.get_table_names()
+        return self.catalog.get_tables()
+
+    def prefetch(self, tables):
+        self.catalog.prefetch(tables)
 
     def get_namespaces(self):
+        """
+        Groups of tables displayed on the map: the schemas when there are
+        several of them, otherwise the tables names prefixes
+        """
+        if len(self.catalog.get_schemas()) > 1:
+            return self.catalog.memo('schema_namespaces', self._get_schema_namespaces)
+        return self.get_prefixes()
+
+    def _get_schema_namespaces(self):
+        namespaces = {}
+        for table in self.get_tables():
+            namespaces.setdefault(table.schema or self.inspector.default_schema_name, []).append(table)
+        return namespaces
+
+    def get_prefixes(self):
+        return self.catalog.memo('prefixes', self._get_prefixes)
+
+    def _get_prefixes(self):
         # Grouping based on http://stackoverflow.com/questions/7852384/finding-multiple-common-starting-strings
         stringsByPrefix = {}
         for string in self.get_tables():
-            if '_' not in string:
+            if '_' not in string.name:
                 continue
-            prefix, suffix = string.split('_', 1)
+            prefix, suffix = string.name.split('_', 1)
             group = stringsByPrefix.setdefault(prefix, [])
             group.append(string)
 
@@ -62,16 +148,18 @@ class DB:
         return stringsByPrefix
 
     def get_column_names(self, table):
-        return [col['name'] for col in self.inspector.get_columns(table)]
+        return [col['name'] for col in self.catalog.get_columns(table)]
 
     def get_columns(self, table_name):
+        """
+        Returns the ColumnInfo of the columns of the table, with the errors
+        found on their values
+        """
         columns = []
+        table_name = self.catalog.get_table_name(table_name)
         sizes = self.get_table_size(table_name)
-        session = self.Session()
 
-        # reflect table from db
-        table = Table(table_name, MetaData())
-        self.inspector.reflecttable(table, None)
+        table = self.catalog.reflect_table(table_name)
 
         for col in table.columns:
             try:
@@ -82,148 +170,227 @@ class DB:
                 print('Unknown datatype, ignoring column %s of table %s' % (table, col.name), file=sys.stderr)
                 continue
 
-            # XXX hack to work with mysql which doesn't have a real 'boolean' type
-            is_bool = isinstance(col.type, Boolean) or (isinstance(col.type, Integer) and getattr(col.type, 'display_width', None) == 1)
+            columns.append(col)
+        infos = [ColumnInfo.from_column(col) for col in columns]
 
-            col.errors = []
+        if self.stats_only:
             if sizes[4] >= MIN_TABLE_SIZE:
-                try:
-                    # Take ROW_LIMITs random rows
-                    subtable = session.query(col).select_from(table).order_by(func.random()).\
-                                    limit(ROW_LIMIT).subquery()
-                    sub_col = getattr(subtable.c, col.name)
-                    res = session.query(sub_col, func.count(sub_col)).group_by(sub_col).limit(MIN_TABLE_SIZE).all()
-                except InvalidRequestError:
-                    print('Invalid request on:', table, col.name, file=sys.stderr)
-                    continue
-                if len(res) == 1 and res[0][1] > 1:
-                    col.errors.append('value is always "%s"' % res[0][0])
-                elif not is_bool:
-                    if len(res) == 2:
-                        col.errors.append('value is always "%s" or "%s"' % (res[0][0], res[1][0]))
-                    elif sizes[4] >= 2 * MIN_TABLE_SIZE and len(res) < MIN_TABLE_SIZE and not isinstance(col.type, Enum):
-                        col.errors.append('has less than %s distinct values' % MIN_TABLE_SIZE)
-            columns.append(col)
-        return columns
+                for col, info in zip(columns, infos):
+                    res = self._get_statistics_values_count(table_name, col.name, sizes[4])
+                    if res is not None:
+                        info.errors += self._check_column_values(col, res, sizes[4])
+        elif sizes[4] >= MIN_TABLE_SIZE and len(columns):
+            try:
+                values, sampled = self._get_values_count(table, columns, sizes[4])
+            except InvalidRequestError:
+                print('Invalid request on:', table, file=sys.stderr)
+                return infos
+            except ProgrammingError:
+                # On permission denied
+                print('Unable to read table %s, its columns values are not checked' % table, file=sys.stderr)
+                return infos
+
+            # The sample may be smaller than expected, when the rows count
+            # is a stale estimate for instance
+            if sampled < MIN_TABLE_SIZE:
+                return infos
+            for col, info, res in zip(columns, infos, values):
+                info.errors += self._check_column_values(col, res, sampled)
+        return infos
+
+    def _get_values_count(self, table, columns, row_count):
+        """
+        Count the values of the columns on a single sample of the table.
+        Returns, for each column, up to MIN_TABLE_SIZE (value, count) pairs,
+        and the number of rows sampled.
+        """
+        counters = [Counter() for col in columns]
+        sampled = 0
+        session = self.Session()
+        try:
+            for row in session.execute(self.sampler.sample(table, row_count, columns)):
+                sampled += 1
+                for counter, value in zip(counters, row):
+                    # NULL values are not counted, like count(column) does
+                    counter[_hashable(value)] += value is not None
+        finally:
+            session.close()
+        return [counter.most_common(MIN_TABLE_SIZE) for counter in counters], sampled
+
+    def _get_statistics_values_count(self, table, column, row_count):
+        """
+        Estimates the values count returned by _get_values_count() from the
+        planner statistics, returns None when the column has none
+        """
+        statistics = self.catalog.get_column_statistics().get((table, column))
+        if statistics is None:
+            return None
+
+        distinct, values = statistics
+        if distinct < 0:
+            distinct = -distinct * row_count
+        distinct = min(max(int(round(distinct)), len(values)), MIN_TABLE_SIZE)
+
+        res = [(value, int(round(frequency * row_count))) for value, frequency in values[:distinct]]
+        # Only the most common values are known
+        res += [('?', 1)] * (distinct - len(res))
+        return res
+
+    def _check_column_values(self, col, res, row_count):
+        """
+        Returns the errors found on the values count of the column
+        """
+        errors = []
+        # XXX hack to work with mysql which doesn't have a real 'boolean' type
+        is_bool = isinstance(col.type, Boolean) or (isinstance(col.type, Integer) and getattr(col.type, 'display_width', None) == 1)
+
+        if len(res) == 1 and res[0][1] > 1:
+            errors.append('value is always "%s"' % res[0][0])
+        elif not is_bool:
+            if len(res) == 2:
+                errors.append('value is always "%s" or "%s"' % (res[0][0], res[1][0]))
+            elif row_count >= 2 * MIN_TABLE_SIZE and len(res) < MIN_TABLE_SIZE and not isinstance(col.type, Enum):
+                errors.append('has less than %s distinct values' % MIN_TABLE_SIZE)
+        return errors
 
     def get_table_keys(self, table):
         keys = [k['constrained_columns'][0] for k in \
-                    self.inspector.get_foreign_keys(table)]
-        keys += self.inspector.get_pk_constraint(table)['constrained_columns']
+                    self.catalog.get_foreign_keys(table)]
+        keys += self.catalog.get_pk_constraint(table)['constrained_columns']
         return keys
 
     def get_table_index(self, table):
-        return [idx['column_names'][0] for idx in self.inspector.get_indexes(table)]
+        return [idx['column_names'][0] for idx in self.catalog.get_indexes(table)]
 
     def get_foreign_keys(self, table):
-        return [((table, c['constrained_columns'][0]), (c['referred_table'], c['referred_columns'][0])) for c in self.inspector.get_foreign_keys(table)]
-
-    def get_missing_constraints(self, table):
-        class LoopBreak(Exception):
-            pass
-        missings = []
-        constraints = self.get_foreign_keys(table)
-        namespaces = self.get_namespaces()
-        columns = self.get_column_names(table)
+        table = self.catalog.get_table_name(table)
+        foreign_keys = []
+        for c in self.catalog.get_foreign_keys(table):
+            schema = c.get('referred_schema')
+            if schema is None and self.engine.dialect.name != 'postgresql':
+                # The schema is omitted for the tables of the same schema,
+                # PostgreSQL omits it for the tables of the search path
+                schema = table.schema
+            referred_table = self.catalog.get_table(c['referred_table'], schema)
+            foreign_keys.append(((table, c['constrained_columns'][0]), (referred_table, c['referred_columns'][0])))
+        return foreign_keys
+
+    def _get_missing_constraints_index(self):
+        """
+        Maps the columns names which look like a reference to a table, to the
+        list of these tables, in the tables order
+        """
+        namespaces = self.get_prefixes()
+        index = {}
         for other_table in self.get_tables():
-            if other_table == table:
-                continue
             prefixes = ['']
-            if '_' in other_table:
-                namespace = other_table.split('_', 1)[0]
+            if '_' in other_table.name:
+                namespace = other_table.name.split('_', 1)[0]
                 if namespace in namespaces:
                     prefixes.append(namespace + '_')
 
-            try:
-                for column in columns:
-                    has_constraint = False
-                    for src, dst in constraints:
-                        if (table, column) == src and dst[0] == other_table:
-                            has_constraint = True
-                    if has_constraint:
-                        continue
-                    for pattern in ['', 'id', '_id', '_ptr_id']:
-                        for other_pattern_prefix in prefixes:
-                            for other_pattern in ['', 's']:
-                                if other_pattern_prefix + column + other_pattern == \
-                                        other_table + pattern:
-                                    constraints = self.get_foreign_keys(table)
-                                    missings.append((table, column, other_table, 'missing constraint\\nor ambiguous naming'))
-                                    raise LoopBreak
-            except LoopBreak:
-                pass
-        return missings
+            # Columns named so that prefix + column + suffix == other_table + pattern
+            for pattern in ['', 'id', '_id', '_ptr_id']:
+                name = other_table.name + pattern
+                for prefix in prefixes:
+                    for suffix in ['', 's']:
+                        if not name.startswith(prefix) or not name.endswith(suffix) or \
+                                len(name) < len(prefix) + len(suffix):
+                            continue
+                        column = name[len(prefix):len(name) - len(suffix)]
+                        targets = index.setdefault(column, [])
+                        if not targets or targets[-1] != other_table:
+                            targets.append(other_table)
+        return index
 
-    def get_inherited_tables(self):
-        # Based on http://stackoverflow.com/questions/1461722/how-to-find-child-tables-that-inherit-from-another-table-in-psql
-        try:
-            r = self.engine.execute('''SELECT
-                p.relname AS parent, c.relname AS child
-            FROM
-                pg_inherits JOIN pg_class AS c ON (inhrelid=c.oid)
-                    JOIN pg_class as p ON (inhparent=p.oid);''')
-            res = r.fetchall()
-            return res
-        except Exception:
-            # if not supported by db
-            return []
+    def get_missing_constraints(self, table):
+        """
+        Returns the columns of the table named after a table of the same
+        schema, without a foreign key to it
+        """
+        table = self.catalog.get_table_name(table)
+        index = self.catalog.memo('missing_constraints_index', self._get_missing_constraints_index)
+        tables_order = self.catalog.memo('tables_order', lambda: {t: n for n, t in enumerate(self.get_tables())})
+        constraints = set((src[1], dst[0]) for src, dst in self.get_foreign_keys(table))
+
+        # First column of the table referencing each other table
+        references = {}
+        for column in self.get_column_names(table):
+            for other_table in index.get(column, []):
+                if other_table == table or other_table in references or \
+                        other_table.schema != table.schema or (column, other_table) in constraints:
+                    continue
+                references[other_table] = column
 
-    def get_table_size(self, table):
-        # Based on http://www.niwi.be/2013/02/17/postgresql-database-table-indexes-size/
-        # TODO: remove try/except, use a portable query
-        try:
-            try:
-                r = self.engine.execute('select pg_relation_size(%(table_name)s), pg_total_relation_size(%(table_name)s)', {'table_name': table})
-            except Exception:
-                r = self.engine.execute('select data_length, data_length + index_length FROM information_schema.TABLES WHERE table_name = %s', table)
+        return [(table, references[other_table], other_table, 'missing constraint\\nor ambiguous naming')
+                for other_table in sorted(references, key=tables_order.get)]
 
-            size, total_size = r.fetchone()
+    def get_inherited_tables(self):
+        return self.catalog.get_inherited_tables()
 
-            r = self.engine.execute('select count(*) from %s' % table)
-            count = r.fetchone()[0]
-            return [sizeof_fmt(size), sizeof_fmt(total_size), size, total_size, int(count)]
-        except ProgrammingError:
-            # On permission denied
-            return ['0', '0', 0, 0, 0]
+    def get_table_size(self, table):
+        return self.catalog.get_table_size(table)
 
     def get_duplicated_tables(self):
         tables = self.get_tables()
         columns = {}
-        for table in tables:
-            columns[table] = set(self.get_column_names(table))
+        # Tables having each column, in the tables order
+        tables_by_column = {}
+        # Tables having the same set of columns
+        tables_by_columns = {}
+        for no, table in enumerate(tables):
+            columns[table] = frozenset(self.get_column_names(table))
+            for column in columns[table]:
+                tables_by_column.setdefault(column, []).append(no)
+            tables_by_columns.setdefault(columns[table], []).append(no)
 
         inherited = self.get_inherited_tables()
-        inherited = ['/'.join(sorted([src, dst])) for src, dst in inherited]
+        inherited = set('/'.join(sorted([src, dst])) for src, dst in inherited)
         duplicated = {}
         for idx, table in enumerate(tables):
-            for other_table in tables[idx + 1:]:
+            # Following tables with the same columns
+            same = [no for no in tables_by_columns[columns[table]] if no > idx]
+
+            # Following tables having all the columns of this one, starting
+            # from the least common column
+            others = set()
+            if len(columns[table]) > 2:
+                for column in sorted(columns[table], key=lambda col: len(tables_by_column[col])):
+                    candidates = set(no for no in tables_by_column[column] if no > idx)
+                    if others:
+                        others &= candidates
+                    else:
+                        others = candidates
+                    if not others:
+                        break
+                others.difference_update(same)
+
+            for no in sorted(same + list(others)):
+                other_table = tables[no]
                 dup_name = '/'.join(sorted([table, other_table]))
                 if dup_name in inherited:
                     continue
 
                 if columns[table] == columns[other_table]:
-                    if dup_name not in duplicated:
-                        duplicated[dup_name] = []
-                    duplicated[dup_name] += ['same columns, could inherit']
-                elif (columns[table].issubset(columns[other_table]) or \
-                        columns[table].issubset(columns[other_table])) and \
-                        len(columns[table] & columns[other_table]) > 2:
-                    if dup_name not in duplicated:
-                        duplicated[dup_name] = []
-                    duplicated[dup_name] += ['could inherit']
+                    duplicated.setdefault(dup_name, []).append('same columns, could inherit')
+                else:
+                    duplicated.setdefault(dup_name, []).append('could inherit')
 
         return duplicated
 
     def get_table_errors(self, table):
         table_size = self.get_table_size(table)[4]
         errors = []
-        if table_size == 0:
+        if not self.catalog.is_row_count_known(table):
+            # Only the planner statistics are read, and there are none
+            pass
+        elif table_size == 0:
             errors += ['empty table']
         elif table_size < MIN_TABLE_SIZE:
             errors += ['has only %s rows' % table_size]
 
-        foreign = self.inspector.get_foreign_keys(table)
-        primary = self.inspector.get_pk_constraint(table)
+        foreign = self.catalog.get_foreign_keys(table)
+        primary = self.catalog.get_pk_constraint(table)
         inherited = self.get_inherited_tables()
 
         if len(foreign) == 0 and len(primary) == 0 and \
@@ -231,11 +398,31 @@ class DB:
             errors += ['has no foreign or primary key']
         return errors
 
+    def analyze_table(self, table):
+        """
+        Returns the description of the table used by the graphs and the HTML pages:
+        (table, errors, sizes, keys, indexes, columns, triggers)
+        """
+        columns = self.get_columns(table)
+        sizes = self.get_table_size(table)
+        keys = self.get_table_keys(table)
+        indexes = self.get_table_index(table)
+        errors = self.get_table_errors(table)
+        triggers = self.get_triggers(table)
+        return (table, errors, sizes, keys, indexes, columns, triggers)
+
     # TODO: Factorize the get_functions/get_triggers below
     def get_functions(self):
+        """
+        Yields the name, language and code of the stored functions, the rows
+        are streamed from a server side cursor
+        """
         # http://stackoverflow.com/questions/16632117/get-all-procedural-user-defined-functions
+        if self.engine.dialect.name != 'postgresql':
+            return
         try:
-            r = self.engine.execute('''SELECT
+            with self.engine.connect() as conn:
+                r = conn.execution_options(stream_results=True).execute('''SELECT
                     pp.proname,
                     pl.lanname,
                     pg_get_functiondef(pp.oid)
@@ -245,28 +432,16 @@ class DB:
                     WHERE pl.lanname NOT IN ('c','internal')
                         AND pn.nspname NOT LIKE 'pg_%%'
                         AND pn.nspname <> 'information_schema';''')
-            res = r.fetchall()
-            return res
+                while True:
+                    rows = r.fetchmany(FUNCTIONS_FETCH_SIZE)
+                    if not rows:
+                        break
+                    for row in rows:
+                        yield tuple(row)
         except Exception:
             from traceback import print_exc
             print_exc()
             # if not supported by db
-            return []
 
     def get_triggers(self, table):
-        # http://serverfault.com/questions/331024/how-can-i-show-the-content-of-a-trigger-with-psql
-        try:
-            r = self.engine.execute('''SELECT trigger_name,
-                        event_manipulation,
-                        action_statement,
-                        action_timing
-                    FROM information_schema.triggers
-                    WHERE event_object_table = '%s'
-                    ORDER BY event_object_table,event_manipulation''' % table)
-            res = r.fetchall()
-            return res
-        except Exception:
-            from traceback import print_exc
-            print_exc()
-            # if not supported by db
-            return []
+        return self.catalog.get_triggers(table)
@@ -16,6 +16,7 @@
 
 from collections import OrderedDict
 import copy
+import json
 import os
 
 from pygal import Pie, Config
@@ -24,6 +25,8 @@ from pygal.style import SolidColorStyle
 from .output_file import OutputFile, OUTPUT_DIR
 
 TOP_N_VALUES = 10
+# Tables displayed per page of the sizes pages
+PAGE_SIZE = 50
 
 
 def humanize(s, counter_type):
@@ -69,8 +72,8 @@ class DBSize(OutputFile):
         }),
     ))
 
-    def __init__(self):
-        super(DBSize, self).__init__('total-0.png')
+    def __init__(self, output_dir=OUTPUT_DIR):
+        super(DBSize, self).__init__('total-0.png', output_dir)
         self.tables_size = {}
         self.total_size = {}
         self.lines_count_size = {}
@@ -89,7 +92,7 @@ class DBSize(OutputFile):
         self.pygal_config.truncate_legend = 9999999
 
     def _get_filename(self, base, n):
-        return os.path.join(OUTPUT_DIR, '%s-%i.svg' % (base, n))
+        return os.path.join(self.output_dir, '%s-%i.svg' % (base, n))
 
     def add_table(self, table, sizes):
         sizes = [int(s) for s in sizes[2:]]
@@ -108,8 +111,32 @@ class DBSize(OutputFile):
         for label, val in zip(labels, values):
             pie_chart.add(label, val)
         pie_chart.render_to_file(filename)
+        self.notify_written(filename, os.path.getsize(filename))
+
+    def render_data(self, filename='sizes.js'):
+        """
+        Writes the sizes of all the tables, browsed by the DBSizeFile pages.
+
+        The data is JSON assigned to a variable, so that the pages can load
+        it from the local disk.
+        """
+        tables = sorted(self.total_size)
+        data = {
+            'page_size': PAGE_SIZE,
+            'graphs': [dict(name=name, **conf) for name, conf in self.GRAPHS.items()],
+            'tables': tables,
+            'values': dict((graph, [int(getattr(self, graph + '_size')[table]) for table in tables])
+                           for graph in self.GRAPHS),
+        }
+        data_file = OutputFile(filename, self.output_dir)
+        data_file.write('DB_SIZES = %s;' % json.dumps(data, separators=(',', ':'), sort_keys=True))
+        data_file.close()
 
     def render(self):
+        """
+        Renders the top tables pies, and writes the sizes of all the tables
+        """
+        self.render_data()
         imgs = []
 
         for i, graph in enumerate(self.GRAPHS.keys()):
@@ -131,18 +158,4 @@ class DBSize(OutputFile):
             labels = ['%s %s' % (val[0], humanize(val[1], self.GRAPHS[graph]['counter_type'])) for val in total_values]
             self._render_pie(values, labels, title, filename)
 
-            def grouped(iterable, n):
-                "s -> (s0,s1,s2,...sn-1), (sn,sn+1,sn+2,...s2n-1), (s2n,s2n+1,s2n+2,...s3n-1), ..."
-                return zip(*[iter(iterable)]*n)
-
-            # Other graphs
-            groups = list(grouped(sorted_values, TOP_N_VALUES))
-            for j, values in enumerate(groups):
-                filename = self._get_filename(graph + str(i), j)
-                title = '%s %s' % (self.GRAPHS[graph]['title'], 'All %i/%i' % (j + 1, len(groups)))
-                imgs[-1].append({'title': title, 'filename':filename})
-
-                _values = [val[1] for val in values]
-                labels = ['%s %s' % (val[0], humanize(val[1], self.GRAPHS[graph]['counter_type'])) for val in values]
-                self._render_pie(_values, labels, title, filename)
         return imgs
@@ -14,17 +14,171 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import shlex
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+import hashlib
+import os
 import subprocess
-import sys
+import threading
+
+from .output_file import OutputFile, OUTPUT_DIR
+
+
+# Graphs with more nodes are laid out with sfdp, dot is too slow on them
+SFDP_MIN_NODES = 500
+
+
+class RenderError(Exception):
+    pass
+
+
+def get_engine(nodes):
+    """
+    Returns the Graphviz layout command for a graph of nodes nodes
+    """
+    if nodes >= SFDP_MIN_NODES:
+        return 'sfdp'
+    return 'dot'
+
+
+_versions = {}
+_versions_lock = threading.Lock()
+
+
+def get_engine_version(engine):
+    """
+    Returns the version displayed by the Graphviz command, as its output
+    may change from a version to another
+    """
+    with _versions_lock:
+        if engine not in _versions:
+            try:
+                _versions[engine] = subprocess.check_output([engine, '-V'], stderr=subprocess.STDOUT)
+            except (OSError, subprocess.CalledProcessError):
+                _versions[engine] = b''
+        return _versions[engine]
 
-from .output_file import OutputFile
 
 class DotFile(OutputFile):
+    # FileCache of the rendered images, by hash of the graph source
+    cache = None
+
+    def __init__(self, filename, engine='dot', output_dir=OUTPUT_DIR):
+        super(DotFile, self).__init__(filename, output_dir)
+        self.engine = engine
+
+    def _get_cache_key(self, gv_file):
+        key = hashlib.sha1()
+        key.update(self.engine.encode('utf-8') + b'\0' + get_engine_version(self.engine) + b'\0')
+        with open(gv_file, 'rb') as f:
+            key.update(f.read())
+        return key.hexdigest()
+
     def render(self, gv_file):
-        cmd = ['dot', '-Tcmapx', '-o' + self.filename + '.map', '-Tpng', '-o' + self.filename, gv_file]
+        outputs = {'png': self.filename, 'map': self.filename + '.map'}
+        key = None
+        if self.cache is not None:
+            key = self._get_cache_key(gv_file)
+            if self.cache.get(key, outputs):
+                self._notify_outputs()
+                return
+
+        cmd = [self.engine, '-Tcmapx', '-o' + self.filename + '.map', '-Tpng', '-o' + self.filename, gv_file]
 
         try:
-            output = subprocess.check_output(cmd)
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
         except subprocess.CalledProcessError as e:
-            print('Error: command exited while processing fie %s with status %i, displaying:\n%s' % (gv_file, e.returncode, e.output), file=sys.stderr)
+            raise RenderError('command exited with status %i, displaying:\n%s' % (e.returncode, e.output.decode(errors='replace')))
+
+        if key is not None:
+            self.cache.put(key, outputs)
+        self._notify_outputs()
+
+    def _notify_outputs(self):
+        if self.write_listener is not None:
+            for filename in (self.filename, self.filename + '.map'):
+                self.notify_written(filename, os.path.getsize(filename))
+
+
+class DotScheduler:
+    """
+    Runs the dot commands concurrently, on a bounded number of workers.
+
+    Errors are collected per .gv file instead of being displayed, they are
+    returned by close(). At most pending jobs are queued, submit() blocks
+    until a worker is available.
+
+    Several runs can share the scheduler, each submitting its jobs in its
+    own group and waiting for them with wait().
+    """
+    def __init__(self, jobs=None, pending=None):
+        jobs = jobs or os.cpu_count()
+        self.executor = ThreadPoolExecutor(max_workers=jobs)
+        # Errors and pending jobs by group
+        self.errors = OrderedDict()
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pending or 2 * jobs)
+
+    def submit(self, dot, gv_file, callback=None, context=None, group=None):
+        """
+        Renders gv_file with the DotFile dot, then calls callback (from the
+        worker thread) so it can use the rendered image. Both run inside the
+        context manager context when one is given. Returns a future which
+        completes when both are done.
+        """
+        self._slots.acquire()
+        future = self.executor.submit(self._run, dot, gv_file, callback, context, group)
+        with self._lock:
+            self.pending.setdefault(group, set()).add(future)
+        future.add_done_callback(partial(self._done, group))
+        return future
+
+    def _done(self, group, future):
+        with self._lock:
+            # The group may already be waited for, callbacks run after the
+            # future is completed
+            self.pending.get(group, set()).discard(future)
+        self._slots.release()
+
+    def _run(self, dot, gv_file, callback, context, group):
+        if context is not None:
+            with context:
+                return self._run(dot, gv_file, callback, None, group)
+
+        try:
+            dot.render(gv_file)
+        except Exception as e:
+            self._add_error(group, gv_file, e)
+
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                self._add_error(group, gv_file, e)
+
+    def _add_error(self, group, gv_file, error):
+        with self._lock:
+            self.errors.setdefault(group, OrderedDict()).setdefault(gv_file, []).append(str(error))
+
+    def wait(self, group=None):
+        """
+        Waits for the jobs of the group to complete, returns their errors
+        """
+        with self._lock:
+            futures = list(self.pending.get(group, []))
+        wait(futures)
+        with self._lock:
+            self.pending.pop(group, None)
+            return self.errors.pop(group, OrderedDict())
+
+    def close(self):
+        """
+        Waits for all jobs to complete and returns the errors
+        """
+        self.executor.shutdown(wait=True)
+        errors = OrderedDict()
+        for _errors in self.errors.values():
+            errors.update(_errors)
+        return errors
@@ -0,0 +1,177 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple, OrderedDict
+
+# kind is one of EDGE_KINDS, args are the arguments of the GV.add_<kind> method
+Edge = namedtuple('Edge', ('kind', 'src', 'dst', 'args'))
+EDGE_KINDS = ('constraint', 'missing_constraint', 'inherited', 'duplicate')
+
+# Group of the tables which are not in a namespace, namespaces never start with _
+OTHER_NAMESPACE = '_other'
+
+
+class SchemaGraph:
+    """
+    Tables and the links between them.
+
+    Each table is described by the tuple returned by DB.analyze_table(),
+    links are kept in the order they were added, and indexed by table.
+    External tables are linked tables which are not analyzed, only their
+    linked columns are known.
+    """
+    def __init__(self):
+        self.tables = OrderedDict()
+        self.external = OrderedDict()
+        self.edges = []
+        self.adjacency = {}
+
+    def add_table(self, table, description=None):
+        self.tables[table] = description
+        self.adjacency.setdefault(table, [])
+
+    def add_external_table(self, table, column):
+        columns = self.external.setdefault(table, [])
+        if column not in columns:
+            columns.append(column)
+        self.adjacency.setdefault(table, [])
+
+    def add_edge(self, kind, src, dst, *args):
+        if kind not in EDGE_KINDS:
+            raise Exception('Invalid edge kind %s' % kind)
+        no = len(self.edges)
+        self.edges.append(Edge(kind, src, dst, args))
+        self.adjacency.setdefault(src, []).append(no)
+        if dst != src:
+            self.adjacency.setdefault(dst, []).append(no)
+
+    def get_edges(self, tables):
+        """
+        Returns the links from or to the tables, in the order they were added
+        """
+        edges = set()
+        for table in tables:
+            edges.update(self.adjacency.get(table, []))
+        return [self.edges[no] for no in sorted(edges)]
+
+    def group_tables(self, namespaces):
+        """
+        Returns the tables of each namespace (as returned by
+        DB.get_namespaces()), the other tables are grouped in OTHER_NAMESPACE
+        """
+        groups = OrderedDict()
+        grouped = set()
+        for namespace in sorted(namespaces):
+            groups[namespace] = [table for table in namespaces[namespace] if table in self.tables]
+            grouped.update(groups[namespace])
+
+        others = [table for table in self.tables if table not in grouped]
+        if others:
+            groups[OTHER_NAMESPACE] = others
+        return groups
+
+    def count_namespace_links(self, groups):
+        """
+        Returns the number of links of each kind between each pair of
+        namespaces (source, destination), links inside a namespace included
+        """
+        namespace_of = {}
+        for namespace, tables in groups.items():
+            for table in tables:
+                namespace_of[table] = namespace
+
+        links = OrderedDict()
+        for edge in self.edges:
+            if edge.src in self.external or edge.dst in self.external:
+                continue
+            key = (namespace_of.get(edge.src, OTHER_NAMESPACE), namespace_of.get(edge.dst, OTHER_NAMESPACE))
+            counts = links.setdefault(key, OrderedDict())
+            counts[edge.kind] = counts.get(edge.kind, 0) + 1
+        return links
+
+    def get_neighbourhood(self, table, depth=1):
+        """
+        Returns the links of the tables less than depth links away from the
+        table, in the order they were added
+        """
+        return [self.edges[no] for no in sorted(self._walk(table, depth)[1])]
+
+    def get_neighbour_tables(self, table, depth=1):
+        """
+        Returns the tables displayed in the neighbourhood of the table,
+        including itself and the external tables
+        """
+        return self._walk(table, depth)[0]
+
+    def _walk(self, table, depth):
+        seen = set([table])
+        level = [table]
+        edges = set()
+        for i in range(depth):
+            next_level = []
+            for name in level:
+                for no in self.adjacency.get(name, []):
+                    edges.add(no)
+                    edge = self.edges[no]
+                    for other_table in (edge.src, edge.dst):
+                        if other_table not in seen:
+                            seen.add(other_table)
+                            next_level.append(other_table)
+            level = next_level
+        return seen, edges
+
+
+class NeighbourhoodTracker:
+    """
+    Follows the tables described so far, to find the tables whose whole
+    neighbourhood is described and can be rendered.
+
+    All the links must have been added to the graph beforehand.
+    """
+    def __init__(self, graph, depth=1):
+        # Number of tables not described yet in the neighbourhood of each table
+        self.missing = {}
+        # Tables waiting for each table to be described
+        self.waiting = {}
+        for table in graph.tables:
+            # External tables are never described
+            neighbours = [neighbour for neighbour in graph.get_neighbour_tables(table, depth)
+                          if neighbour not in graph.external]
+            self.missing[table] = len(neighbours)
+            for neighbour in neighbours:
+                self.waiting.setdefault(neighbour, []).append(table)
+
+    def add(self, table):
+        """
+        Records that the table is described, returns the tables which can now
+        be rendered
+        """
+        ready = []
+        for waiting in self.waiting.pop(table, []):
+            self.missing[waiting] -= 1
+            if not self.missing[waiting]:
+                del self.missing[waiting]
+                ready.append(waiting)
+        return ready
+
+    def get_waiting(self):
+        """
+        Returns the tables whose neighbourhood is still not fully described,
+        and forgets them
+        """
+        waiting = list(self.missing)
+        self.missing.clear()
+        return waiting
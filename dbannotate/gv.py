@@ -14,9 +14,12 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
 import cgi
+import re
 
-from .output_file import OutputFile
+from .graph import OTHER_NAMESPACE
+from .output_file import OutputFile, OUTPUT_DIR
 
 GV_HEADER = """
 digraph G {
@@ -30,11 +33,37 @@ GV_FOOTER = """
 """
 GV_SEPARATOR = '__42deadbeef__'
 
+# Color of the links between namespaces in the overview map, by kind
+OVERVIEW_COLORS = {
+    'constraint': 'black',
+    'missing_constraint': 'red',
+    'inherited': 'limegreen',
+    'duplicate': 'red',
+}
+
+
+def gv_id(name):
+    """
+    Returns name as a Graphviz ID, quoted unless it is a plain identifier
+    (tables of other schemas are qualified with a dot)
+    """
+    if re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name):
+        return name
+    return '"%s"' % name.replace('"', '\\"')
+
+
+def namespace_title(namespace):
+    if namespace == OTHER_NAMESPACE:
+        return 'Other tables'
+    return namespace.title()
+
 
 class GV(OutputFile):
-    def __init__(self, filename, minimap=False):
-        super(GV, self).__init__(filename)
-        self.tables = []
+    BUFFERED = True
+
+    def __init__(self, filename, minimap=False, output_dir=OUTPUT_DIR):
+        super(GV, self).__init__(filename, output_dir)
+        self.tables = set()
         self.minimap = minimap
 
     def _escape(self, s):
@@ -48,7 +77,7 @@ class GV(OutputFile):
     def add_table(self, name, errors, sizes, keys, indexes, columns, triggers, highlight=False):
         if name in self.tables:
             return
-        self.tables.append(name)
+        self.tables.add(name)
         sizes = [sizes[i] for i in (1, 0, 4)]
 
         color = 'white'
@@ -66,7 +95,7 @@ class GV(OutputFile):
         if not highlight:
             url = 'URL="%s.html"' % name
 
-        table = """{name} [ {url} {fontsize} label=<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">
+        table = """{id} [ {url} {fontsize} label=<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">
         <TR>
             <TD PORT="{name}" BGCOLOR="{color}"><B>{name} ({sizes})</B></TD>
         """
@@ -79,7 +108,8 @@ class GV(OutputFile):
                 <TD ALIGN="left" BGCOLOR="{color}">{errors}</TD>"""
         table += '</TR>'
         errors = [self._escape(err) for err in errors]
-        table = table.format(name=name,
+        table = table.format(id=gv_id(name),
+                        name=name,
                         color=color,
                         sizes='/'.join([str(n) for n in sizes]),
                         errors=', '.join(errors),
@@ -99,9 +129,9 @@ class GV(OutputFile):
             unique = '*' if col.unique else ''
 
             # Data type
-            col_type = str(col.type).lower()
-            if col.server_default is not None:
-                default = str(col.server_default.arg)
+            col_type = col.type
+            if col.default is not None:
+                default = col.default
                 if default.startswith('nextval'):
                     default = 'nextval'
                 col_type += '/def:' + default
@@ -130,37 +160,141 @@ class GV(OutputFile):
             self.write(column)
         self.write("</TABLE>>];")
 
+    def add_external_table(self, name, columns):
+        """
+        Adds a table which is not analyzed, with the linked columns
+        """
+        if name in self.tables:
+            return
+        self.tables.add(name)
+
+        fontsize = 'fontsize="7"' if self.minimap else 'fontsize="10"'
+        self.write('%s [ %s label=<<TABLE BORDER="0" CELLBORDER="1" CELLSPACING="0">' % (gv_id(name), fontsize))
+        self.write('<TR><TD PORT="%s" BGCOLOR="lightgray"><I>%s</I></TD></TR>' % (name, name))
+        if not self.minimap:
+            for col in columns:
+                self.write('<TR><TD ALIGN="left" PORT="%s" BGCOLOR="lightgray">%s</TD></TR>' %
+                           (GV_SEPARATOR.join([name, col]), col))
+        self.write('</TABLE>>];')
+
+    def add_graph_table(self, graph, table, **kwargs):
+        """
+        Adds a table of the SchemaGraph, analyzed or external
+        """
+        if table in graph.external:
+            self.add_external_table(table, graph.external[table])
+        else:
+            self.add_table(*graph.tables[table], **kwargs)
+
+    def add_graph(self, graph):
+        """
+        Adds all the tables and links of the SchemaGraph
+        """
+        for description in graph.tables.values():
+            self.add_table(*description[:6], triggers=[])
+        for table, columns in graph.external.items():
+            self.add_external_table(table, columns)
+        for edge in graph.edges:
+            getattr(self, 'add_' + edge.kind)(*edge.args)
+
+    def add_neighbourhood(self, graph, table, depth=1):
+        """
+        Adds the table, highlighted, and the tables and links around it in the
+        SchemaGraph, up to depth links away
+        """
+        self.add_table(*graph.tables[table], highlight=True)
+        for edge in graph.get_neighbourhood(table, depth):
+            self.add_graph_table(graph, edge.src)
+            self.add_graph_table(graph, edge.dst)
+            getattr(self, 'add_' + edge.kind)(*edge.args)
+
+    def add_overview(self, groups, links):
+        """
+        Adds a node per namespace of groups (as returned by
+        SchemaGraph.group_tables()), linking to its map, and the number of
+        links between namespaces
+        """
+        for namespace, tables in groups.items():
+            self.write('"%s" [URL="map_%s.html" shape="box" fontsize="10" label="%s (%i tables)"];' %
+                       (namespace, namespace, namespace_title(namespace), len(tables)))
+
+        for (src, dst), counts in links.items():
+            if src == dst:
+                continue
+            for kind, count in counts.items():
+                self.write('"%s" -> "%s" [label="%i" fontcolor="%s" color="%s"];' %
+                           (src, dst, count, OVERVIEW_COLORS[kind], OVERVIEW_COLORS[kind]))
+
+    def add_namespace_graph(self, graph, groups, namespace):
+        """
+        Adds the tables of the namespace and the links between them, the
+        links to other namespaces are counted on a link to their map
+        """
+        tables = set(groups[namespace])
+        for table in groups[namespace]:
+            self.add_table(*graph.tables[table][:6], triggers=[])
+
+        namespace_of = {}
+        for _namespace, _tables in groups.items():
+            for table in _tables:
+                namespace_of[table] = _namespace
+
+        others = OrderedDict()
+        for edge in graph.get_edges(groups[namespace]):
+            if edge.src in tables and edge.dst in tables:
+                getattr(self, 'add_' + edge.kind)(*edge.args)
+                continue
+            if edge.dst in graph.external:
+                # External tables are not in a namespace
+                self.add_external_table(edge.dst, graph.external[edge.dst])
+                getattr(self, 'add_' + edge.kind)(*edge.args)
+                continue
+            # Links to the outside of the namespace go to the namespace of the other table
+            if edge.src in tables:
+                other, table = namespace_of.get(edge.dst, OTHER_NAMESPACE), edge.src
+            else:
+                other, table = namespace_of.get(edge.src, OTHER_NAMESPACE), edge.dst
+            others.setdefault(other, OrderedDict())
+            others[other][table] = others[other].get(table, 0) + 1
+
+        for other, counts in others.items():
+            self.write('"ns:%s" [URL="map_%s.html" shape="box" label="%s"];' %
+                       (other, other, namespace_title(other)))
+            for table, count in counts.items():
+                self.write('%s -> "ns:%s" [label="%i" style="dashed"];' % (gv_id(table), other, count))
+
     def add_constraint(self, src, dst):
         if self.minimap:
-            self.write("%s -> %s;" % (src[0], dst[0]))
+            self.write("%s -> %s;" % (gv_id(src[0]), gv_id(dst[0])))
         else:
-            self.write("%s:%s1:e -> %s:%s:w;" % (src[0], GV_SEPARATOR.join(src),
-                                                 dst[0], GV_SEPARATOR.join(dst)))
+            self.write("%s:%s:e -> %s:%s:w;" % (gv_id(src[0]), gv_id(GV_SEPARATOR.join(src) + '1'),
+                                                gv_id(dst[0]), gv_id(GV_SEPARATOR.join(dst))))
 
     def add_missing_constraint(self, table, column, other_table, error):
         if self.minimap:
-            self.write('%s -> %s [fontcolor="red", color="red"];' % (table, other_table))
+            self.write('%s -> %s [fontcolor="red", color="red"];' % (gv_id(table), gv_id(other_table)))
         else:
-            self.write('%s:%s1:e -> %s [label="%s" fontcolor="red", color="red"];' % (table, GV_SEPARATOR.join([table, column]),
-                                    other_table, error))
+            self.write('%s:%s:e -> %s [label="%s" fontcolor="red", color="red"];' % (gv_id(table),
+                                    gv_id(GV_SEPARATOR.join([table, column]) + '1'), gv_id(other_table), error))
 
     def add_inherited(self, src, dst):
         # :s for the South side of the table
         if self.minimap:
-            self.write('%s -> %s [fontcolor="limegreen" color="limegreen"];' % (dst, src))
+            self.write('%s -> %s [fontcolor="limegreen" color="limegreen"];' % (gv_id(dst), gv_id(src)))
         else:
-            self.write('%s -> %s:n [label="inherits" fontcolor="limegreen" color="limegreen"];' % (dst, src))
+            self.write('%s -> %s:n [label="inherits" fontcolor="limegreen" color="limegreen"];' % (gv_id(dst), gv_id(src)))
 
     def add_duplicate(self, src, dst, duplicate_type):
         if self.minimap:
-            self.write('%s -> %s [fontcolor="red" color="red"];' % (src, dst))
+            self.write('%s -> %s [fontcolor="red" color="red"];' % (gv_id(src), gv_id(dst)))
         else:
-            self.write('%s -> %s:n [label="%s" fontcolor="red" color="red"];' % (src, dst, ', '.join(duplicate_type)))
+            self.write('%s -> %s:n [label="%s" fontcolor="red" color="red"];' % (gv_id(src), gv_id(dst),
+                                                                              ', '.join(duplicate_type)))
 
     def add_footer(self):
         self.write(GV_FOOTER)
 
     def add_namespace(self, namespace, tables):
-        self.write('%s [label="%s", shape="square"];' % (namespace, namespace.title()))
+        self.write('%s [label="%s", shape="square"];' % (gv_id(namespace), namespace.title()))
         for table in tables:
-            self.write('%s -> %s [style="dashed"];' % (namespace, table))
+            self.write('%s -> %s [style="dashed"];' % (gv_id(namespace), gv_id(table)))
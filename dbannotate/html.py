@@ -16,13 +16,16 @@
 
 from cgi import escape
 from datetime import datetime
+import hashlib
 import os
 import re
 
+import pygments
 from pygments import highlight
 from pygments.formatters import HtmlFormatter
 from pygments.lexers.sql import MySqlLexer, PlPgsqlLexer, PostgresConsoleLexer, PostgresLexer, SqlLexer, SqliteConsoleLexer
 
+from .cache import FileCache
 from .db_size import humanize
 from .output_file import OutputFile, OUTPUT_DIR
 
@@ -55,17 +58,72 @@ class HTMLFile(OutputFile):
             self.write('<a href="index.html">Back...</a><br/>')
         self._render(*args, **kw)
         self.write(HTML_FOOTER)
+        self.close()
+
+# Displays a page of the tables sizes written by DBSize.render_data(), the
+# page number is the URL fragment
+SIZES_JS = """
+function humanize(s, counterType) {
+    var prefixes = ['', 'k', 'M', 'G', 'T', 'P'];
+    var base = counterType == 'b' ? 1024 : 1000;
+    for (var i = 0; i < prefixes.length; i++) {
+        if (s < base)
+            return Math.floor(s) + prefixes[i] + counterType;
+        s = s / base;
+    }
+    return 'total count too big';
+}
+
+function escapeHtml(s) {
+    return String(s).replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;').replace(/"/g, '&quot;');
+}
+
+function showSizes(graphNo) {
+    var graph = DB_SIZES.graphs[graphNo];
+    var values = DB_SIZES.values[graph.name];
+    var order = DB_SIZES.tables.map(function(table, no) { return no; });
+    order.sort(function(a, b) { return values[b] - values[a]; });
+    var pages = Math.max(1, Math.ceil(order.length / DB_SIZES.page_size));
+
+    function show() {
+        var page = Math.min(Math.max(parseInt(location.hash.substr(1)) || 1, 1), pages);
+        var max = values[order[0]] || 1;
+        var html = '<h2>' + graph.title + ' ' + page + '/' + pages + '</h2><table>';
+        var lines = order.slice((page - 1) * DB_SIZES.page_size, page * DB_SIZES.page_size);
+        lines.forEach(function(no) {
+            var table = DB_SIZES.tables[no];
+            html += '<tr><td><a href="' + encodeURIComponent(table) + '.html">' + escapeHtml(table) + '</a></td>' +
+                    '<td align="right">' + humanize(values[no], graph.counter_type) + '</td>' +
+                    '<td><div style="background: #00a4ff; height: 1em; width: ' +
+                    Math.round(400 * values[no] / max) + 'px"></div></td></tr>';
+        });
+        html += '</table>';
+        if (page > 1)
+            html += '<a href="#' + (page - 1) + '">Previous</a> ';
+        if (page < pages)
+            html += '<a href="#' + (page + 1) + '">Next</a>';
+        document.getElementById('sizes').innerHTML = html;
+    }
+
+    window.onhashchange = show;
+    show();
+}
+"""
+
 
 class DBSizeFile(HTMLFile):
-    def __init__(self, filename, dbsize_no):
-        HTMLFile.__init__(self, '%s%i.html' % (filename, dbsize_no))
+    def __init__(self, filename, dbsize_no, output_dir=OUTPUT_DIR):
+        HTMLFile.__init__(self, '%s%i.html' % (filename, dbsize_no), output_dir)
         self.dbsize_no = dbsize_no
 
     def _render(self, objects):
         for obj in objects:
             self.write('''<figure style="display: inline"><embed type="image/svg+xml" src="%s" width="40%%" height="40%%"/>
             </figure>''' % (obj['url']))
-        self.write(HTML_FOOTER)
+        # All the tables are paged from the sizes data
+        self.write('<div id="sizes"></div>')
+        self.write('<script type="text/javascript" src="sizes.js"></script>')
+        self.write('<script type="text/javascript">%s\nshowSizes(%i);</script>' % (SIZES_JS, self.dbsize_no))
 
 
 class TableFile(HTMLFile):
@@ -73,6 +131,9 @@ class TableFile(HTMLFile):
     def get_table_html(img):
         map_file = img + '.map'
         img = os.path.basename(img)
+        if not os.path.exists(map_file):
+            # The image failed to render
+            return '<img src="%s" />' % img
         html = '<img src="%s" usemap="#mainmap" /><map id="mainmap" name="mainmap">' % img
         map_file = open(map_file, 'r')
         html += map_file.read()
@@ -106,9 +167,14 @@ class TableFile(HTMLFile):
 
         self.write(TableFile.get_table_html(self.filename.replace('.html', '.png')))
 
+class MapFile(HTMLFile):
+    def _render(self, title):
+        self.write('<h1>%s</h1>' % escape(title))
+        self.write(TableFile.get_table_html(self.filename.replace('.html', '.png')))
+
 class IndexFile(HTMLFile):
     BACK_BUTTON = False
-    def _render(self, objects, db_size, db, functions):
+    def _render(self, objects, db_size, url, tables_count, functions):
         for obj in objects:
             for _obj in obj:
                 _obj['url'] = os.path.basename(_obj['filename'])
@@ -118,9 +184,9 @@ class IndexFile(HTMLFile):
                         <li>Date: %s</li>
                         <li>Tables count: %s</li>
                         <li>Total size: %s</li>
-                    </ul>''' % (repr(db.engine.url),
+                    </ul>''' % (url,
                                 datetime.now().strftime('%x'),
-                                len(db.get_tables()),
+                                tables_count,
                                 humanize(sum(db_size.total_size.values()), 'b')))
 
         for i, obj in enumerate(objects):
@@ -128,7 +194,7 @@ class IndexFile(HTMLFile):
                 <figure style="display: inline">
                     <a href="graph_%i.html"><embed type="image/svg+xml" src="%s" width="40%%" height="40%%"/>More...</a>
                 </figure>''' % (i, obj[0]['url']))
-            page = DBSizeFile('graph_', i)
+            page = DBSizeFile('graph_', i, self.output_dir)
             page.render(obj)
 
         # Sort tables by total size of the first type of graph
@@ -155,25 +221,83 @@ class IndexFile(HTMLFile):
                 self.write('<td>%s</td>' % _table)
             self.write('</tr>')
         self.write('</table>')
-        self.write(TableFile.get_table_html(os.path.join(OUTPUT_DIR, 'map.png')))
+        self.write(TableFile.get_table_html(os.path.join(self.output_dir, 'map.png')))
         if len(functions):
             self.write('<h2>Functions</h2>')
             self.write('<table><tr><th>Name</th><th>Lines count</th></tr>')
             for function in functions:
-                self.write('<tr><td><a href="fn_%s.html">%s</a></td>' % (function[0], function[0]))
+                self.write('<tr><td><a href="%s">%s</a></td>' % (function[2], function[0]))
                 self.write('<td>%i</td></tr>' % function[1])
             self.write('</table>')
 
+class SummaryFile(HTMLFile):
+    BACK_BUTTON = False
+    def _render(self, databases):
+        self.write('''<ul>
+                        <li>Date: %s</li>
+                        <li>Databases count: %i</li>
+                    </ul>''' % (datetime.now().strftime('%x'), len(databases)))
+
+        self.write('<table><tr><th>Database</th><th>URI</th><th>Tables count</th>'
+                   '<th>Total size</th><th>Rendering errors</th></tr>')
+        for database in databases:
+            if database['failure'] is not None:
+                self.write('<tr><td>%s</td><td>%s</td><td colspan="3">%s</td></tr>' %
+                           (database['name'], escape(database['uri']), escape(database['failure'])))
+                continue
+            self.write('<tr><td><a href="%s/index.html">%s</a></td><td>%s</td><td>%i</td><td>%s</td><td>%i</td></tr>' %
+                       (database['name'], database['name'], escape(database['uri']), database['tables'],
+                        humanize(database['size'], 'b'), database['errors']))
+        self.write('</table>')
+
+class ProfileFile(HTMLFile):
+    @staticmethod
+    def _format(value):
+        if isinstance(value, float):
+            return '%.3f' % value
+        return escape(str(value))
+
+    def _write_table(self, title, columns, lines):
+        self.write('<h2>%s</h2>' % title)
+        self.write('<table><tr>%s</tr>' % ''.join(['<th>%s</th>' % col.replace('_', ' ').title() for col in columns]))
+        for line in lines:
+            self.write('<tr>%s</tr>' % ''.join(['<td>%s</td>' % self._format(line[col]) for col in columns]))
+        self.write('</table>')
+
+    def _render(self, phases, tables, queries):
+        self.write('<h1>Profile</h1>')
+        self._write_table('Phases', ['name', 'time', 'statements', 'rows', 'sql_time', 'bytes'], phases)
+
+        tables = [dict(table, time=', '.join(['%s: %.3f' % (phase, t) for phase, t in table['time'].items()]))
+                  for table in tables]
+        self._write_table('Slowest tables', ['name', 'total_time', 'time', 'statements', 'rows', 'sql_time', 'bytes'], tables)
+        self._write_table('Slowest queries', ['statement', 'time', 'count', 'max_time', 'rows'], queries)
+
 
 FORMATTER = HtmlFormatter()
+
+
+def get_formatter_signature(formatter):
+    """
+    Changes when the highlighted HTML may change: on a pygments upgrade or a
+    change of the formatter options or style
+    """
+    return '%s\0%r\0%s' % (pygments.__version__, sorted(formatter.options.items()),
+                            formatter.get_style_defs('.highlight'))
+
+FORMATTER_SIGNATURE = get_formatter_signature(FORMATTER)
+
 class HilightCSSFile(OutputFile):
-    def __init__(self):
-        super(HilightCSSFile, self).__init__('highlight.css')
+    def __init__(self, output_dir=OUTPUT_DIR):
+        super(HilightCSSFile, self).__init__('highlight.css', output_dir)
     def render(self):
         self.write(FORMATTER.get_style_defs('.highlight'))
+        self.close()
 
 class FunctionFile(HTMLFile):
     CSS = ['highlight.css']
+    # FileCache of the highlighted code, by hash of the code and of the formatter
+    cache = None
     LEXERS = {
         'plpgsql': PlPgsqlLexer(),
         'sql': SqlLexer(),
@@ -182,12 +306,62 @@ class FunctionFile(HTMLFile):
     def _get_lexer(self, language):
         return self.LEXERS.get(language)
 
-    def _render(self, function, language, code):
+    def _highlight(self, language, code):
         lexer = self._get_lexer(language)
-        if lexer is not None:
-            highlighted = highlight(code, lexer, FORMATTER)
-        else:
-            highlighted = '<pre>%s</pre>' % escape(code)
+        if lexer is None:
+            return '<pre>%s</pre>' % escape(code)
+
+        key = None
+        if self.cache is not None:
+            key = hashlib.sha1('\0'.join([FORMATTER_SIGNATURE, language, code]).encode('utf-8')).hexdigest()
+            highlighted = self.cache.get_content(key, 'html')
+            if highlighted is not None:
+                return highlighted.decode('utf-8')
+
+        highlighted = highlight(code, lexer, FORMATTER)
+        if key is not None:
+            self.cache.put_content(key, {'html': highlighted.encode('utf-8')})
+        return highlighted
+
+    def _render(self, function, language, code):
+        highlighted = self._highlight(language, code)
         self.write('<h1>Function %s</h1>' % function)
         self.write('%s language' % language)
         self.write(highlighted)
+
+
+def init_function_worker(cache_dir, cache_size):
+    """
+    Sets up the highlighting cache of a worker process
+    """
+    if cache_dir is not None:
+        FunctionFile.cache = FileCache(cache_dir, cache_size)
+
+
+def get_function_pages(functions):
+    """
+    Yields the page filename and the function for the stored functions
+    (name, language, code). Overloaded functions share a name, the first
+    one gets the fn_<name>.html page the triggers link to.
+    """
+    counts = {}
+    for function in functions:
+        no = counts[function[0]] = counts.get(function[0], 0) + 1
+        if no == 1:
+            yield 'fn_%s.html' % function[0], function
+        else:
+            # Dots are not allowed in unquoted function names
+            yield 'fn_%s.%i.html' % (function[0], no), function
+
+
+def render_function(output_dir, page):
+    """
+    Writes the page of a stored function returned by get_function_pages(),
+    returns its filename, name and lines count. Runs in worker processes.
+    """
+    # TODO: there may be a naming conflict with table names here:
+    filename, function = page
+    fn_name, fn_lang, fn_code = function
+    html = FunctionFile(filename, output_dir)
+    html.render(*function)
+    return html.filename, fn_name, len(fn_code.splitlines())
@@ -0,0 +1,95 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+
+from .output_file import OUTPUT_DIR
+
+# Increase when the generated files change for the same tables
+MANIFEST_VERSION = 2
+
+
+def describe_table(table, errors, sizes, keys, indexes, columns, triggers):
+    """
+    Returns what is displayed of a table, as a json serializable object
+    """
+    return [table, errors, [sizes[0], sizes[1], sizes[4]], keys, indexes, [col.dump() for col in columns],
+            [list(trigger) for trigger in triggers]]
+
+
+def _describe_graph_table(graph, table):
+    if table in graph.external:
+        return [table, graph.external[table]]
+    return describe_table(*graph.tables[table])
+
+
+def fingerprint(graph, table, depth=1):
+    """
+    Hash of a table and of its neighbourhood in the SchemaGraph
+    """
+    data = [describe_table(*graph.tables[table])]
+    for edge in graph.get_neighbourhood(table, depth):
+        data.append([_describe_graph_table(graph, edge.src), _describe_graph_table(graph, edge.dst),
+                     edge.kind, edge.args])
+    data = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """
+    Fingerprints of the tables rendered by the previous run
+    """
+    def __init__(self, filename='manifest.json', output_dir=OUTPUT_DIR):
+        self.output_dir = output_dir
+        self.filename = os.path.join(output_dir, filename)
+        self.previous = self._load()
+        self.current = {}
+
+    def _load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest.get('tables', {})
+
+    def is_unchanged(self, table, fingerprint, filenames):
+        """
+        Records the table fingerprint, returns True when the files generated
+        for it by the previous run are still up to date
+        """
+        self.current[table] = fingerprint
+        if self.previous.get(table) != fingerprint:
+            return False
+        return all(os.path.exists(os.path.join(self.output_dir, filename)) for filename in filenames)
+
+    def discard(self, table):
+        """
+        Forget the table so that it is rendered again on the next run
+        """
+        self.current.pop(table, None)
+
+    def get_removed_tables(self):
+        return [table for table in self.previous if table not in self.current]
+
+    def save(self):
+        with open(self.filename, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'tables': self.current}, f, sort_keys=True)
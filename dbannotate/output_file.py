@@ -20,23 +20,49 @@ OUTPUT_DIR = 'db_annotate'
 
 
 class OutputFile:
-    def __init__(self, filename):
+    # Keep the content in memory and write it at once on close(), so that no
+    # file descriptor is held while the content is generated
+    BUFFERED = False
+
+    # Called with the filename and the number of bytes each time a file is written
+    write_listener = None
+
+    def __init__(self, filename, output_dir=OUTPUT_DIR):
         self.fd = None
+        self.buffer = []
         self.basename = filename
-        self.filename = os.path.join(OUTPUT_DIR, filename)
+        self.output_dir = output_dir
+        self.filename = os.path.join(output_dir, filename)
+
+    @classmethod
+    def notify_written(cls, filename, size):
+        if cls.write_listener is not None:
+            cls.write_listener(filename, size)
 
     @staticmethod
-    def create_outputdir():
-        if not os.path.exists(OUTPUT_DIR):
-            os.mkdir(OUTPUT_DIR)
+    def create_outputdir(output_dir=OUTPUT_DIR):
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
 
     def close(self):
+        if self.buffer:
+            buf = ''.join(self.buffer)
+            with open(self.filename, 'w') as fd:
+                fd.write(buf)
+            self.buffer = []
+            if self.write_listener is not None:
+                self.notify_written(self.filename, len(buf.encode('utf-8')))
         if self.fd is not None:
             self.fd.close()
 
     def write(self, buf):
-        if self.fd is None:
-            self.fd = open(self.filename, 'w')
         if '\n' not in buf:
             buf += '\n'
+        if self.BUFFERED:
+            self.buffer.append(buf)
+            return
+        if self.fd is None:
+            self.fd = open(self.filename, 'w')
         self.fd.write(buf)
+        if self.write_listener is not None:
+            self.notify_written(self.filename, len(buf.encode('utf-8')))
@@ -0,0 +1,168 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from .html import ProfileFile
+from .output_file import OutputFile, OUTPUT_DIR
+from .timer import PhaseTimer
+
+# Number of tables and queries listed in the HTML report
+TOP_N = 50
+
+
+def _counters():
+    return {'statements': 0, 'rows': 0, 'sql_time': 0.0, 'bytes': 0}
+
+
+class Profiler(PhaseTimer):
+    """
+    Records, for each phase and each table, the wall time, the number of SQL
+    statements and of rows, and the number of bytes written.
+
+    Rows are counted as reported by the database driver, some drivers (like
+    SQLite) do not report the rows returned by select statements.
+    """
+    def __init__(self, engine):
+        super(Profiler, self).__init__()
+        self.engine = engine
+        self.phases_counters = OrderedDict()
+        self.tables = {}
+        self.queries = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # Without engine, only the time and bytes written are recorded
+        if engine is not None:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        OutputFile.write_listener = self._on_write
+
+    def close(self):
+        if self.engine is not None:
+            event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.remove(self.engine, 'after_cursor_execute', self._after_cursor_execute)
+        if OutputFile.write_listener == self._on_write:
+            OutputFile.write_listener = None
+
+    def start(self, name):
+        super(Profiler, self).start(name)
+        self._get_counters(self.phases_counters, name)
+        # Work done by this thread is accounted to the phase, until it is stopped
+        self._local.phases = getattr(self._local, 'phases', []) + [name]
+
+    def stop(self, name):
+        super(Profiler, self).stop(name)
+        self._local.phases.remove(name)
+
+    @contextmanager
+    def table(self, phase, name=None):
+        previous = getattr(self._local, 'table', None), getattr(self._local, 'phases', [])
+        self._local.table = name
+        self._local.phases = previous[1] + [phase]
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if name is not None:
+                with self._lock:
+                    times = self._get_table(name)['time']
+                    times[phase] = times.get(phase, 0) + elapsed
+            self._local.table, self._local.phases = previous
+
+    def _get_counters(self, counters, name):
+        if name not in counters:
+            counters[name] = _counters()
+        return counters[name]
+
+    def _get_table(self, name):
+        if name not in self.tables:
+            self.tables[name] = _counters()
+            self.tables[name]['time'] = OrderedDict()
+        return self.tables[name]
+
+    def _account(self, **values):
+        phases = getattr(self._local, 'phases', [])
+        table = getattr(self._local, 'table', None)
+        with self._lock:
+            counters = [self._get_counters(self.phases_counters, phases[-1] if phases else 'other')]
+            if table is not None:
+                counters.append(self._get_table(table))
+            for _counters in counters:
+                for key, value in values.items():
+                    _counters[key] += value
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('profiler_start', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['profiler_start'].pop()
+        rows = max(cursor.rowcount, 0)
+        self._account(statements=1, rows=rows, sql_time=elapsed)
+        with self._lock:
+            query = self.queries.setdefault(statement, {'count': 0, 'time': 0.0, 'max_time': 0.0, 'rows': 0})
+            query['count'] += 1
+            query['time'] += elapsed
+            query['max_time'] = max(query['max_time'], elapsed)
+            query['rows'] += rows
+
+    def _on_write(self, filename, size):
+        self._account(bytes=size)
+
+    def get_report(self):
+        phases = []
+        for name, counters in self.phases_counters.items():
+            phase = OrderedDict([('name', name), ('time', self.phases.get(name, 0))])
+            phase.update(sorted(counters.items()))
+            phases.append(phase)
+
+        tables = []
+        for name, counters in self.tables.items():
+            table = OrderedDict([('name', name), ('total_time', sum(counters['time'].values()))])
+            table.update(sorted(counters.items()))
+            tables.append(table)
+        tables.sort(key=lambda table: table['total_time'], reverse=True)
+
+        queries = []
+        for statement, counters in self.queries.items():
+            query = OrderedDict([('statement', statement)])
+            query.update(sorted(counters.items()))
+            queries.append(query)
+        queries.sort(key=lambda query: query['time'], reverse=True)
+
+        return OrderedDict([('phases', phases), ('tables', tables), ('queries', queries)])
+
+    def save(self, json_file='profile.json', html_file='profile.html', output_dir=OUTPUT_DIR):
+        """
+        Writes the report as JSON, and the phases, slowest tables and slowest
+        queries as HTML
+        """
+        self.close()
+        report = self.get_report()
+        OutputFile.create_outputdir(output_dir)
+        with open(os.path.join(output_dir, json_file), 'w') as f:
+            json.dump(report, f, indent=2)
+
+        html = ProfileFile(html_file, output_dir)
+        html.render(report['phases'], report['tables'][:TOP_N], report['queries'][:TOP_N])
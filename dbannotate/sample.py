@@ -0,0 +1,115 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+
+from sqlalchemy import and_, select, tablesample, union_all
+from sqlalchemy.sql import func
+from sqlalchemy.types import Integer
+
+# Sampling methods:
+# - auto: the best method supported by the database
+# - system, bernoulli: PostgreSQL TABLESAMPLE methods, system reads random pages
+#   while bernoulli reads random rows of the whole table
+# - range: rows following random primary key values, in RANGES slices of
+#   the keys
+# - random: rows sorted by random(), this sorts the whole table
+# - limit: the first rows of the table
+SAMPLE_METHODS = ('auto', 'system', 'bernoulli', 'range', 'random', 'limit')
+SAMPLE_METHOD = 'auto'
+SAMPLE_SIZE = 1000
+
+# Sample more rows than needed with TABLESAMPLE, as the percentage is based on
+# the estimated rows count
+OVERSAMPLING = 2
+
+# Number of ranges read by the range method, the rows of a range are often
+# inserted together and have similar values
+RANGES = 10
+
+# system samples whole pages, their rows are as clustered as a range
+AUTO_METHODS = {
+    'postgresql': 'bernoulli',
+    'mysql': 'range',
+}
+
+
+class Sampler:
+    def __init__(self, engine, method=SAMPLE_METHOD, size=SAMPLE_SIZE):
+        if method not in SAMPLE_METHODS:
+            raise Exception('Invalid sampling method %s' % method)
+        if method == 'auto':
+            method = AUTO_METHODS.get(engine.dialect.name, 'limit')
+        self.engine = engine
+        self.method = method
+        self.size = size
+
+    def sample(self, table, row_count, columns=None):
+        """
+        Returns a select statement of at most self.size rows of the table
+        """
+        if columns is None:
+            columns = list(table.columns)
+
+        if row_count <= self.size:
+            # The whole table fits in the sample
+            return select(columns).limit(self.size)
+        return getattr(self, '_sample_' + self.method)(table, row_count, columns)
+
+    def _tablesample(self, table, row_count, columns, method):
+        percent = min(100.0, 100.0 * self.size * OVERSAMPLING / row_count)
+        sampled = tablesample(table, getattr(func, method)(percent))
+        # The oversampled rows are shuffled, the first ones would come from
+        # the first pages
+        return select([sampled.c[col.name] for col in columns]).order_by(func.random()).limit(self.size)
+
+    def _sample_system(self, table, row_count, columns):
+        return self._tablesample(table, row_count, columns, 'system')
+
+    def _sample_bernoulli(self, table, row_count, columns):
+        return self._tablesample(table, row_count, columns, 'bernoulli')
+
+    def _sample_range(self, table, row_count, columns):
+        pk = list(table.primary_key.columns)
+        if len(pk) != 1 or not isinstance(pk[0].type, Integer):
+            return self._sample_limit(table, row_count, columns)
+        pk = pk[0]
+
+        r = self.engine.execute(select([func.min(pk), func.max(pk)]))
+        low, high = r.fetchone()
+        if low is None:
+            return self._sample_limit(table, row_count, columns)
+
+        # A range in each slice of the keys, so that they do not overlap
+        size = max(1, self.size // RANGES)
+        # Keep enough keys after the start of a range to fill it
+        span = (high - low) * size // row_count
+        ranges = []
+        for no in range(RANGES):
+            first = low + (high - low + 1) * no // RANGES
+            last = low + (high - low + 1) * (no + 1) // RANGES
+            if first >= last:
+                continue
+            start = random.randint(first, max(first, last - 1 - span))
+            ranges.append(select(columns).where(and_(pk >= start, pk < last)).order_by(pk).limit(size)
+                          .alias('range%i' % no))
+        return union_all(*[select(list(_range.c)) for _range in ranges])
+
+    def _sample_random(self, table, row_count, columns):
+        return select(columns).order_by(func.random()).limit(self.size)
+
+    def _sample_limit(self, table, row_count, columns):
+        return select(columns).limit(self.size)
@@ -0,0 +1,150 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import threading
+import zipfile
+
+from .catalog import TableName
+from .db import ColumnInfo
+
+# Increase when the content of the snapshots changes
+SNAPSHOT_VERSION = 1
+
+
+def _dumps(data):
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+class SnapshotWriter:
+    """
+    Writes the analysis of a database to a zip file.
+
+    meta.json holds the tables with their sizes and links, the namespaces and
+    the functions count. The description of each table and each function
+    are separate entries, written as soon as they are known and read only
+    when needed.
+    """
+    def __init__(self, filename, url):
+        self.filename = filename
+        # The snapshot is complete once renamed
+        self.zip = zipfile.ZipFile(filename + '.tmp', 'w', zipfile.ZIP_DEFLATED)
+        self.meta = {'version': SNAPSHOT_VERSION, 'url': url, 'tables': [], 'namespaces': {},
+                     'inherited': [], 'duplicates': {}, 'functions': 0}
+        self.tables_no = {}
+
+    def add_table(self, table, sizes, foreign_keys, missing_constraints):
+        self.tables_no[table] = len(self.meta['tables'])
+        self.meta['tables'].append({'name': table.name, 'schema': table.schema, 'sizes': sizes,
+                                    'foreign_keys': foreign_keys, 'missing_constraints': missing_constraints})
+
+    def set_links(self, namespaces, inherited, duplicates):
+        self.meta['namespaces'] = namespaces
+        self.meta['inherited'] = inherited
+        self.meta['duplicates'] = duplicates
+
+    def add_description(self, description):
+        """
+        Writes the description of a table returned by DB.analyze_table()
+        """
+        table, errors, sizes, keys, indexes, columns, triggers = description
+        data = [errors, keys, indexes, [col.dump() for col in columns], triggers]
+        self.zip.writestr('tables/%i.json' % self.tables_no[table], _dumps(data))
+
+    def add_function(self, function):
+        self.zip.writestr('functions/%i.json' % self.meta['functions'], _dumps(function))
+        self.meta['functions'] += 1
+
+    def close(self):
+        self.zip.writestr('meta.json', _dumps(self.meta))
+        self.zip.close()
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def discard(self):
+        self.zip.close()
+        os.unlink(self.filename + '.tmp')
+
+
+class Snapshot:
+    """
+    Analysis of a database read from a snapshot, with the methods of DB used
+    to render it. The tables descriptions and the functions are loaded on
+    demand.
+    """
+    def __init__(self, filename):
+        self.zip = zipfile.ZipFile(filename, 'r')
+        meta = json.loads(self.zip.read('meta.json').decode('utf-8'))
+        if meta.get('version') != SNAPSHOT_VERSION:
+            raise Exception('Unsupported snapshot version %s in %s' % (meta.get('version'), filename))
+
+        self.url = meta['url']
+        self.meta = meta
+        self.tables = [TableName(table['name'], table['schema']) for table in meta['tables']]
+        self.tables_no = dict((table, no) for no, table in enumerate(self.tables))
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.zip.close()
+
+    def _get_table_name(self, table):
+        # TableName of a table name
+        no = self.tables_no.get(table)
+        return table if no is None else self.tables[no]
+
+    def _read(self, name):
+        with self._lock:
+            data = self.zip.read(name)
+        return json.loads(data.decode('utf-8'))
+
+    def get_tables(self):
+        return self.tables
+
+    def prefetch(self, tables):
+        # The catalog is not needed
+        pass
+
+    def get_namespaces(self):
+        return dict((namespace, [self._get_table_name(table) for table in tables])
+                    for namespace, tables in self.meta['namespaces'].items())
+
+    def get_table_size(self, table):
+        return self.meta['tables'][self.tables_no[table]]['sizes']
+
+    def get_foreign_keys(self, table):
+        return [((self._get_table_name(src[0]), src[1]), (self._get_table_name(dst[0]), dst[1]))
+                for src, dst in self.meta['tables'][self.tables_no[table]]['foreign_keys']]
+
+    def get_missing_constraints(self, table):
+        return [(self._get_table_name(table), column, self._get_table_name(other_table), error)
+                for table, column, other_table, error in
+                self.meta['tables'][self.tables_no[table]]['missing_constraints']]
+
+    def get_inherited_tables(self):
+        return [(self._get_table_name(src), self._get_table_name(dst)) for src, dst in self.meta['inherited']]
+
+    def get_duplicated_tables(self):
+        return self.meta['duplicates']
+
+    def analyze_table(self, table):
+        table = self._get_table_name(table)
+        errors, keys, indexes, columns, triggers = self._read('tables/%i.json' % self.tables_no[table])
+        return (table, errors, self.get_table_size(table), keys, indexes,
+                [ColumnInfo.load(col) for col in columns], [tuple(trigger) for trigger in triggers])
+
+    def get_functions(self):
+        for no in range(self.meta['functions']):
+            yield tuple(self._read('functions/%i.json' % no))
@@ -0,0 +1,54 @@
+#
+# Copyright(C) 2015 Romain Bignon, Laurent Defert
+#
+# db_annotate is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# db_annotate is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+
+
+class PhaseTimer:
+    """
+    Wall time spent in each phase of a run, in seconds.
+
+    Phases running in the background (like the graphs rendering) may overlap
+    the following ones.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._started = {}
+
+    def start(self, name):
+        self._started[name] = time.perf_counter()
+
+    def stop(self, name):
+        elapsed = time.perf_counter() - self._started.pop(name)
+        self.phases[name] = self.phases.get(name, 0) + elapsed
+
+    @contextmanager
+    def phase(self, name):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    @contextmanager
+    def table(self, phase, name=None):
+        """
+        Work done for the table name (or for no table in particular) during
+        the phase, possibly from another thread
+        """
+        yield